@@ -37,6 +37,9 @@ def bootstrap():
         rotation="1 day",
         retention="7 days",
         serialize=True,  # Output as JSON
+        enqueue=True,  # Format and write on a background thread, off the event loop
+        encoding="utf-8",
+        compression="gz",
     )
 
     # Intercept exceptions for better error handling
@@ -1,10 +1,13 @@
 import argparse
 import asyncio
+import csv
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack, aclosing
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
 
 import pandas as pd
 from dotenv import load_dotenv
@@ -15,27 +18,136 @@ from invoice_bot.portal_uploader import PortalUploader
 
 
 # Required CSV columns
-REQUIRED_COLUMNS = ["service_id", "price", "invoice_path"]
+REQUIRED_COLUMNS = frozenset({"service_id", "price", "invoice_path"})
+
+# Columns appended to each row in the result CSV
+RESULT_COLUMNS = ["status", "portal_id", "error_msg", "processed_ts"]
 
 # Default concurrency
 DEFAULT_CONCURRENCY = 4
 
+# Number of CSV rows parsed and uploaded per batch
+CSV_CHUNK_SIZE = 1000
+
+# Read service IDs as text so a chunk with a blank cell doesn't turn 1003 into 1003.0
+CSV_DTYPES = {"service_id": str}
+
 
-async def process_row(
-    uploader: PortalUploader, row: Dict[str, Any], semaphore: asyncio.Semaphore
-) -> Dict[str, Any]:
-    """Process a single row with concurrency control via semaphore.
+def _resolve_invoice_path(invoice_path: Any) -> Optional[str]:
+    """Resolve an invoice path to an absolute path string.
     
     Args:
-        uploader: The portal uploader instance
-        row: Dictionary containing row data
-        semaphore: Semaphore to limit concurrency
+        invoice_path: The invoice_path value from the CSV
         
     Returns:
-        Dict with upload result (status, portal_id, error_msg)
+        The resolved path, or None if the file does not exist
+    """
+    try:
+        return str(Path(invoice_path).resolve(strict=True))
+    except (OSError, TypeError):
+        return None
+
+
+async def resolve_invoice_paths(records: List[Dict[str, Any]]) -> None:
+    """Resolve every record's invoice_path into `invoice_file` on worker threads.
+    
+    Keeps the filesystem stats off the event loop and lets missing files be
+    rejected before any browser work.
+    
+    Args:
+        records: Row dictionaries, updated in place
+    """
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor() as executor:
+        paths = await asyncio.gather(*(
+            loop.run_in_executor(executor, _resolve_invoice_path, record["invoice_path"])
+            for record in records
+        ))
+    
+    for record, path in zip(records, paths):
+        record["invoice_file"] = path
+
+
+async def iter_records(reader: Any, csv_file: Path) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Yield the CSV one chunk at a time as row dictionaries.
+    
+    Chunks are parsed on a worker thread, one chunk ahead of the uploads, so
+    parsing overlaps with portal I/O instead of stalling the loop.
+    
+    Args:
+        reader: pandas chunked CSV reader, reading with `CSV_DTYPES`
+        csv_file: Path of the CSV, for logging
+        
+    Yields:
+        Row dictionaries with `price_str` and `invoice_file` filled in
+    """
+    next_chunk = asyncio.create_task(asyncio.to_thread(next, reader, None))
+    try:
+        while (chunk := await next_chunk) is not None:
+            next_chunk = asyncio.create_task(asyncio.to_thread(next, reader, None))
+            logger.info(f"[READ_CSV] Loaded {len(chunk)} rows from {csv_file}")
+            
+            # Format prices once per chunk rather than per row; prices that are
+            # not numbers stay missing and fail their row
+            chunk["price_str"] = pd.to_numeric(chunk["price"], errors="coerce").map(
+                "{:.2f}".format, na_action="ignore"
+            )
+            
+            # Plain dicts, no per-row Series; missing values become None so they
+            # are written back as empty cells
+            records = chunk.astype(object).where(chunk.notna(), None).to_dict(orient="records")
+            await resolve_invoice_paths(records)
+            yield records
+    finally:
+        # Don't leave a read-ahead running in its thread after the reader is closed.
+        # Cancelling the task would not stop a thread already inside next(reader),
+        # so wait for that call to finish instead
+        await asyncio.gather(next_chunk, return_exceptions=True)
+
+
+async def upload_records(
+    uploader: PortalUploader,
+    chunks: AsyncIterator[List[Dict[str, Any]]],
+    concurrency: int,
+    write_result: Callable[[Dict[str, Any]], Awaitable[None]],
+) -> None:
+    """Upload rows through a bounded queue drained by a fixed pool of workers.
+    
+    Only `concurrency` uploads and at most `concurrency * 2` queued rows are
+    in flight at once, instead of one coroutine per row. Each row is handed to
+    `write_result` as soon as it finishes, so no results are kept in memory.
+    
+    Args:
+        uploader: The portal uploader instance
+        chunks: Row dictionaries to upload, one list per CSV chunk
+        concurrency: Number of worker tasks
+        write_result: Called with each finished row merged with its result
+            (status, portal_id, error_msg, processed_ts)
     """
-    async with semaphore:
-        return await uploader.upload_row(dict(row))
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    
+    async def producer() -> None:
+        async for records in chunks:
+            for record in records:
+                await queue.put(record)
+        # One sentinel per worker signals the end of input
+        for _ in range(concurrency):
+            await queue.put(None)
+    
+    async def worker() -> None:
+        while True:
+            # Hold off while the portal is rate limiting us
+            await uploader.wait_for_cooldown()
+            row = await queue.get()
+            if row is None:
+                return
+            result = await uploader.upload_row(row)
+            await write_result({**row, **result})
+    
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(producer())
+        for _ in range(concurrency):
+            tg.create_task(worker())
 
 
 async def main(csv_path: str, headless: bool = True, concurrency: int = DEFAULT_CONCURRENCY) -> int:
@@ -63,66 +175,71 @@ async def main(csv_path: str, headless: bool = True, concurrency: int = DEFAULT_
         logger.error(f"[INIT] CSV file not found: {csv_file}")
         return 1
     
-    # Read CSV with pandas
+    # Read only the header up front; rows are streamed in chunks below
     try:
-        df = pd.read_csv(csv_file)
-        logger.info(f"[READ_CSV] Loaded {len(df)} rows from {csv_file}")
+        header = pd.read_csv(csv_file, nrows=0)
     except Exception as e:
         logger.error(f"[INIT] Failed to read CSV: {e}")
         return 1
     
     # Validate required columns
-    missing_columns = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+    missing_columns = REQUIRED_COLUMNS.difference(header.columns)
     if missing_columns:
-        logger.error(f"[INIT] Missing required columns: {', '.join(missing_columns)}")
+        logger.error(f"[INIT] Missing required columns: {', '.join(sorted(missing_columns))}")
         return 1
     
-    # Create semaphore for concurrency control
-    semaphore = asyncio.Semaphore(concurrency)
-    
-    # Create uploader and process rows
-    results = []
-    async with PortalUploader(headless=headless) as uploader:
-        # Create tasks for each row
-        tasks = [
-            process_row(uploader, row, semaphore) 
-            for _, row in df.iterrows()
-        ]
-        
-        # Run all tasks and collect results
-        results = await asyncio.gather(*tasks)
-    
-    # Process results
-    status_counts = {"OK": 0, "SKIP": 0, "ERROR": 0}
-    for result in results:
-        status_counts[result["status"]] += 1
-    
-    # Add results to DataFrame
-    result_df = df.copy()
-    
-    # Add result columns - we convert the list of dicts to a dict of lists
-    result_dict = {
-        "status": [],
-        "portal_id": [],
-        "error_msg": [],
-        "processed_ts": []
-    }
-    
-    for r in results:
-        result_dict["status"].append(r["status"])
-        result_dict["portal_id"].append(r["portal_id"])
-        result_dict["error_msg"].append(r["error_msg"])
-        result_dict["processed_ts"].append(r["processed_ts"])
-    
-    # Assign the new columns
-    result_df = result_df.assign(**result_dict)
-    
     # Generate output filename with timestamp
     timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
     output_csv = f"run-{timestamp}.csv"
     
-    # Save result CSV
-    result_df.to_csv(output_csv, index=False)
+    # Create uploader and stream rows through it, writing results as they finish
+    status_counts = {"OK": 0, "SKIP": 0, "ERROR": 0}
+    read_failed = False
+    loop = asyncio.get_running_loop()
+    async with AsyncExitStack() as stack:
+        try:
+            uploader = await stack.enter_async_context(
+                PortalUploader(headless=headless, concurrency=concurrency)
+            )
+        except Exception as e:
+            # Browser launch (e.g. profile in use by another run), portal or login failure
+            logger.error(f"[INIT] Failed to start portal session: {type(e).__name__}: {e}")
+            return 1
+        
+        output_file = stack.enter_context(open(output_csv, "w", newline="", encoding="utf-8"))
+        write_executor = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+        
+        # extrasaction="ignore" drops internal keys such as price_str and invoice_file
+        writer = csv.DictWriter(
+            output_file, fieldnames=[*header.columns, *RESULT_COLUMNS], extrasaction="ignore"
+        )
+        writer.writeheader()
+        
+        def write_row(row: Dict[str, Any]) -> None:
+            writer.writerow(row)
+            # Flush per row so partial progress survives a crash
+            output_file.flush()
+        
+        async def write_result(row: Dict[str, Any]) -> None:
+            status_counts[row["status"]] += 1
+            # A single writer thread keeps writes off the loop and serialized
+            await loop.run_in_executor(write_executor, write_row, row)
+        
+        reader = stack.enter_context(pd.read_csv(csv_file, chunksize=CSV_CHUNK_SIZE, dtype=CSV_DTYPES))
+        # Closed before the reader, so any read-ahead finishes while it is still open
+        chunks = await stack.enter_async_context(aclosing(iter_records(reader, csv_file)))
+        try:
+            await upload_records(uploader, chunks, concurrency, write_result)
+        except* (pd.errors.ParserError, UnicodeDecodeError) as eg:
+            # Rows are parsed as they stream, so a malformed line only shows up here
+            logger.error(f"[READ_CSV] Failed to read CSV: {eg.exceptions[0]}")
+            read_failed = True
+    
+    if read_failed:
+        logger.info(f"[SUMMARY_WRITE] Partial results written to {output_csv}")
+        await logger.complete()
+        return 1
+    
     logger.info(f"[SUMMARY_WRITE] Results written to {output_csv}")
     
     # Log summary
@@ -132,6 +249,9 @@ async def main(csv_path: str, headless: bool = True, concurrency: int = DEFAULT_
         f"{status_counts['ERROR']} ERROR, total runtime {elapsed_sec}s"
     )
     
+    # Flush log records still queued for the file sink
+    await logger.complete()
+    
     # Determine exit code
     if status_counts["ERROR"] > 0:
         return 2
@@ -1,11 +1,13 @@
 import asyncio
+import mimetypes
 import os
 import time
+from datetime import datetime
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
 
 from loguru import logger
-from playwright.async_api import async_playwright, Browser, BrowserContext, Page, TimeoutError
+from playwright.async_api import async_playwright, Browser, BrowserContext, Locator, Page, TimeoutError
 
 # Placeholder selectors - to be replaced with actual ones after access to QA mirror
 TODO_SELECTOR_LOGIN_URL = "https://placeholder-portal.example.com/login"
@@ -23,42 +25,133 @@ TODO_SELECTOR_SUCCESS = "text=Success"
 TODO_SELECTOR_PORTAL_ID = "[data-portal-id]"
 TODO_SELECTOR_SERVICE_TABLE = "table"
 
+# JSON endpoint behind the new-service form - to be confirmed on QA mirror
+TODO_API_SERVICES = "/api/services"
+# Statuses meaning the endpoint is absent or not open to this session
+API_MISSING_STATUSES = frozenset({401, 403, 404, 405})
+
 # Rate limit detection
 TODO_SELECTOR_RATE_LIMIT = "text=Rate Limit"
 
+# Upper bound for a single retry backoff, in seconds
+MAX_BACKOFF_SEC = 30
+
+# Returns the portal ID of the service table row containing service_id,
+# "unknown" if the row has no portal ID, or null if there is no such row
+FIND_DUPLICATE_JS = """([serviceId, tableSelector, portalIdSelector]) => {
+    const row = [...document.querySelectorAll(`${tableSelector} tr`)]
+        .find(r => r.textContent.includes(serviceId));
+    if (!row) return null;
+    return row.querySelector(portalIdSelector)?.textContent ?? "unknown";
+}"""
+
 # Base URL (from environment or default)
 BASE_URL = os.getenv("PORTAL_BASE_URL", "https://placeholder-portal.example.com")
-AUTH_FILE = "auth.json"
+# Persistent Chromium profile; keeps the portal session between runs
+PROFILE_DIR = os.getenv("PORTAL_PROFILE_DIR", ".pw-profile")
+# Set PORTAL_USE_API=0 to always upload through the new-service form
+USE_SERVICES_API = os.getenv("PORTAL_USE_API", "1") != "0"
+
+
+def _form_locators(page: Page) -> Dict[str, Locator]:
+    """Build the new-service form locators for a page once, as it joins the pool.
+    
+    Plain CSS selectors get an explicit css= engine prefix so Playwright does
+    not have to detect the selector engine on every action.
+    
+    Args:
+        page: The pooled page
+        
+    Returns:
+        Locators keyed by form field
+    """
+    # .first keeps the first-match behaviour of the page-level calls these
+    # replace; Locator actions are otherwise strict
+    return {
+        "service_id": page.locator(f"css={TODO_SELECTOR_SERVICE_ID}").first,
+        "price": page.locator(f"css={TODO_SELECTOR_PRICE}").first,
+        "invoice_file": page.locator(f"css={TODO_SELECTOR_INVOICE_FILE}").first,
+        "description": page.locator(f"css={TODO_SELECTOR_DESCRIPTION}").first,
+        "invoice_date": page.locator(f"css={TODO_SELECTOR_INVOICE_DATE}").first,
+        "submit": page.locator(TODO_SELECTOR_SUBMIT_BUTTON).first,
+        "success": page.locator(TODO_SELECTOR_SUCCESS).first,
+        # Already a strict page.locator() read before the locators were cached
+        "portal_id": page.locator(f"css={TODO_SELECTOR_PORTAL_ID}"),
+    }
+
+
+# Cache for _processed_ts: the formatted second, reused until the clock ticks over
+_last_ts_sec = 0
+_last_ts_str = ""
+
+
+def _processed_ts() -> str:
+    """Return the current local time as an ISO 8601 string with milliseconds."""
+    global _last_ts_sec, _last_ts_str
+    sec, ns = divmod(time.time_ns(), 1_000_000_000)
+    if sec != _last_ts_sec:
+        _last_ts_sec = sec
+        _last_ts_str = datetime.fromtimestamp(sec).strftime("%Y-%m-%dT%H:%M:%S")
+    return f"{_last_ts_str}.{ns // 1_000_000:03d}"
 
 
 class PortalUploader:
     """Manages a Playwright browser session for uploading invoices to the portal."""
 
-    def __init__(self, headless: bool = True):
+    def __init__(self, headless: bool = True, concurrency: int = 1):
         """Initialize the uploader with browser settings.
         
         Args:
             headless: Whether to run the browser in headless mode
+            concurrency: Maximum number of concurrent uploads, and the number
+                of pages kept open for them
         """
         self.headless = headless
+        self.concurrency = concurrency
         self.playwright = None
+        # Unused: persistent contexts have no separate Browser object
         self.browser = None
         self.context = None
-        self._auth_file = Path(AUTH_FILE)
+        self._profile_dir = Path(PROFILE_DIR)
+        # Caps in-flight uploads (form or API) at `concurrency`
+        self._sem = asyncio.Semaphore(concurrency)
+        self._page_pool: asyncio.Queue[Tuple[Page, Dict[str, Locator]]] = asyncio.Queue()
+        # None until the first services API call shows whether the portal has one
+        self._api_available: Optional[bool] = None if USE_SERVICES_API else False
+        # time.monotonic() deadline of the rate-limit cooldown shared by all workers
+        self._rate_limit_until = 0.0
 
     async def __aenter__(self) -> "PortalUploader":
-        """Set up Playwright and browser for async context manager."""
-        self.playwright = await async_playwright().start()
-        self.browser = await self.playwright.chromium.launch(headless=self.headless)
+        """Set up Playwright and browser for async context manager.
         
-        # Check for existing auth
-        if self._auth_file.exists():
-            logger.info("[AUTH] Using saved cookies from previous session")
-            self.context = await self.browser.new_context(storage_state=str(self._auth_file))
-        else:
-            logger.info("[AUTH] No saved session found, performing fresh login")
-            self.context = await self.browser.new_context()
-            await self._login()
+        Raises:
+            Exception: If the browser, the portal or the login fails; anything
+                already started is shut down first
+        """
+        self.playwright = await async_playwright().start()
+        try:
+            # Fails if another process holds the profile; Chromium locks it
+            self.context = await self.playwright.chromium.launch_persistent_context(
+                user_data_dir=str(self._profile_dir), headless=self.headless
+            )
+            # Check for an existing session on the page the profile opens with
+            page = self.context.pages[0] if self.context.pages else await self.context.new_page()
+            if await self._is_logged_in(page):
+                logger.info("[AUTH] Using saved session from browser profile")
+            else:
+                logger.info("[AUTH] No saved session found, performing fresh login")
+                await self._login(page)
+            
+            # Pre-open one page per concurrent upload so rows reuse warm pages;
+            # the probe page is the first of them
+            self._page_pool.put_nowait((page, _form_locators(page)))
+            for _ in range(self.concurrency - 1):
+                page = await self.context.new_page()
+                self._page_pool.put_nowait((page, _form_locators(page)))
+        except BaseException:
+            # __aexit__ is not called when __aenter__ fails
+            await self.__aexit__(None, None, None)
+            raise
             
         return self
 
@@ -66,13 +159,34 @@ class PortalUploader:
         """Clean up resources when exiting the context manager."""
         if self.context:
             await self.context.close()
-        if self.browser:
-            await self.browser.close()
         if self.playwright:
             await self.playwright.stop()
 
-    async def _login(self) -> None:
-        """Perform login and save auth state."""
+    async def _is_logged_in(self, page: Page) -> bool:
+        """Check whether the profile's cookies still give us a portal session.
+        
+        Args:
+            page: Page to probe with
+            
+        Returns:
+            True if the dashboard loads without logging in
+            
+        Raises:
+            playwright.async_api.Error: If the portal cannot be reached
+        """
+        await page.goto(BASE_URL)
+        try:
+            await page.wait_for_selector(TODO_SELECTOR_DASHBOARD, timeout=3000)
+        except TimeoutError:
+            return False
+        return True
+
+    async def _login(self, page: Page) -> None:
+        """Perform login; the session is kept in the persistent profile.
+        
+        Args:
+            page: Page to log in with
+        """
         # Get credentials from environment
         username = os.getenv("PORTAL_USERNAME")
         password = os.getenv("PORTAL_PASSWORD")
@@ -80,25 +194,22 @@ class PortalUploader:
         if not username or not password:
             raise ValueError("Missing login credentials. Set PORTAL_USERNAME and PORTAL_PASSWORD environment variables.")
         
-        # Create page and navigate to login
-        page = await self.context.new_page()
-        try:
-            await page.goto(TODO_SELECTOR_LOGIN_URL)
-            
-            # Fill login form
-            await page.fill(TODO_SELECTOR_USERNAME, username)
-            await page.fill(TODO_SELECTOR_PASSWORD, password)
-            await page.click(TODO_SELECTOR_SIGNIN_BUTTON)
-            
-            # Wait for successful login
-            await page.wait_for_selector(TODO_SELECTOR_DASHBOARD, timeout=8000)
-            logger.info("[AUTH] Login successful")
-            
-            # Save auth state for future runs
-            await self.context.storage_state(path=str(self._auth_file))
-            logger.info(f"[AUTH] Saved authentication state to {self._auth_file}")
-        finally:
-            await page.close()
+        await page.goto(TODO_SELECTOR_LOGIN_URL)
+        
+        # Fill login form
+        await page.fill(TODO_SELECTOR_USERNAME, username)
+        await page.fill(TODO_SELECTOR_PASSWORD, password)
+        await page.click(TODO_SELECTOR_SIGNIN_BUTTON)
+        
+        # Wait for successful login
+        await page.wait_for_selector(TODO_SELECTOR_DASHBOARD, timeout=8000)
+        logger.info(f"[AUTH] Login successful, session saved to {self._profile_dir}")
+
+    async def wait_for_cooldown(self) -> None:
+        """Wait until any active rate-limit cooldown has elapsed."""
+        # Loop in case another row extended the cooldown while we slept
+        while (delay := self._rate_limit_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
 
     async def _retry_with_backoff(self, func, max_retries=3) -> Any:
         """Execute a function with exponential backoff retry on failure.
@@ -118,6 +229,9 @@ class PortalUploader:
         
         while retries <= max_retries:
             try:
+                # Every attempt honours the shared rate-limit cooldown
+                await self.wait_for_cooldown()
+                
                 if retries > 0:
                     logger.warning(f"Retry attempt {retries}/{max_retries}")
                     
@@ -130,10 +244,18 @@ class PortalUploader:
                 if isinstance(e, TimeoutError) or "429" in str(e) or "Rate Limit" in str(e):
                     retries += 1
                     if retries <= max_retries:
-                        # Exponential backoff: 2^retries * 1000ms
-                        wait_time = (2 ** retries) * 1000
-                        logger.warning(f"Rate limit detected, backing off for {wait_time/1000}s")
-                        await asyncio.sleep(wait_time / 1000)
+                        # Exponential backoff: 2^retries seconds, capped
+                        wait_time = min(2 ** retries, MAX_BACKOFF_SEC)
+                        if isinstance(e, TimeoutError):
+                            logger.warning(f"Timeout, backing off for {wait_time}s")
+                            await asyncio.sleep(wait_time)
+                        else:
+                            # Real rate limit: one shared cooldown for every worker
+                            # instead of each row retrying on its own schedule
+                            logger.warning(f"Rate limit detected, cooling down for {wait_time}s")
+                            self._rate_limit_until = max(
+                                self._rate_limit_until, time.monotonic() + wait_time
+                            )
                     else:
                         logger.error(f"Max retries ({max_retries}) exceeded")
                         raise
@@ -143,99 +265,280 @@ class PortalUploader:
                 
         raise last_exception
 
+    def _log_success(self, row: Dict[str, Any], portal_id: str, start_time: float) -> None:
+        """Log an uploaded row and its timing as a single structured event."""
+        elapsed_ms = int((time.time() - start_time) * 1000)
+        logger.bind(
+            service_id=row["service_id"],
+            invoice_path=row["invoice_path"],
+            portal_id=portal_id,
+            elapsed_ms=elapsed_ms,
+        ).info(
+            f"[ROW_SUCCESS] service_id={row['service_id']}, invoice_path={row['invoice_path']}, "
+            f"portal_id={portal_id}, time={elapsed_ms}ms"
+        )
+
+    def _error_result(self, row: Dict[str, Any], error_msg: str, start_time: float) -> Dict[str, Any]:
+        """Log a failed row and build its ERROR result."""
+        elapsed_ms = int((time.time() - start_time) * 1000)
+        logger.error(f"[ROW_ERROR] service_id={row['service_id']}, error={error_msg}, time={elapsed_ms}ms")
+        
+        return {
+            "status": "ERROR",
+            "portal_id": None,
+            "error_msg": error_msg,
+            "processed_ts": _processed_ts()
+        }
+
+    def _invalid_row_error(self, row: Dict[str, Any]) -> Optional[str]:
+        """Return the error message for a row that cannot be uploaded, if any."""
+        if row.get("price_str") is None:
+            return f"ValueError: Invalid price: {row['price']}"
+        if row.get("invoice_file") is None:
+            return f"FileNotFoundError: Invoice file not found: {row['invoice_path']}"
+        return None
+
+    def _skip_result(self, service_id: str, existing_id: str) -> Dict[str, Any]:
+        """Log a duplicate row and build its SKIP result."""
+        logger.info(f"[ROW_SKIP] service_id={service_id} (duplicate found, portal_id={existing_id})")
+        
+        return {
+            "status": "SKIP",
+            "portal_id": existing_id,
+            "error_msg": None,
+            "processed_ts": _processed_ts()
+        }
+
+    def _mark_api_missing(self) -> None:
+        """Record that the portal has no usable services API and use the form from now on."""
+        if self._api_available is not False:
+            logger.warning("[API] Services API not available, falling back to form uploads")
+        self._api_available = False
+
+    async def _lookup_existing_id(self, service_id: str) -> Optional[str]:
+        """Look up a service_id through the services API, without opening a page.
+        
+        Args:
+            service_id: The service ID to look up
+            
+        Returns:
+            The existing portal ID ("unknown" if the record has none), or None if
+            the service does not exist or the portal has no usable services API
+        """
+        response = await self.context.request.get(
+            f"{BASE_URL}{TODO_API_SERVICES}", params={"service_id": service_id}
+        )
+        if response.status in API_MISSING_STATUSES:
+            # The collection endpoint itself is missing; no match is an empty list
+            self._mark_api_missing()
+            return None
+        if response.status == 429:
+            raise RuntimeError(f"429 Rate Limit: {response.status_text}")
+        if not response.ok:
+            raise RuntimeError(f"HTTP {response.status}: {await response.text()}")
+        
+        try:
+            services = await response.json()
+        except ValueError:
+            services = None
+        if not isinstance(services, list) or not all(isinstance(s, dict) for s in services):
+            # Not the API: e.g. an app catch-all or login page served with 200
+            self._mark_api_missing()
+            return None
+        
+        self._api_available = True
+        if not services:
+            return None
+        return str(services[0].get("portal_id") or "unknown")
+
     async def upload_row(self, row: Dict[str, Any]) -> Dict[str, Any]:
         """Upload a single invoice row to the portal.
         
+        Uses the portal's services API while it has one, so no page is navigated,
+        rendered or submitted. If the API is missing (404), refused (401, 403,
+        405) or does not answer with JSON, the uploader switches to the
+        new-service form for the rest of the run.
+        
         Args:
-            row: Dictionary containing the row data from the CSV
+            row: Dictionary containing the row data from the CSV, with service_id
+                as a string, the price formatted in `price_str` and the resolved
+                invoice path in `invoice_file` (None if invalid or missing)
             
         Returns:
             Dict with status, portal_id (if successful), and error message (if failed)
         """
-        page = await self.context.new_page()
         start_time = time.time()
         
+        # Fail fast on missing invoice files, before any browser work
+        error_msg = self._invalid_row_error(row)
+        if error_msg:
+            return self._error_result(row, error_msg, start_time)
+        
+        # Bound concurrent uploads here so callers can fan out freely
+        async with self._sem:
+            if self._api_available is not False:
+                result = await self._upload_row_api(row, start_time)
+                if result is not None:
+                    return result
+            return await self._upload_row_form(row, start_time)
+
+    async def _upload_row_api(self, row: Dict[str, Any], start_time: float) -> Optional[Dict[str, Any]]:
+        """Upload a single row through the services API.
+        
+        Args:
+            row: Row dictionary, as accepted by `upload_row`
+            start_time: When the row's upload started, for logging
+            
+        Returns:
+            Dict with status, portal_id (if successful), and error message (if
+            failed), or None if the portal has no services API
+        """
+        service_id = row["service_id"]
+        
+        try:
+            # Check for duplicate (if service_id already exists) before submitting
+            existing_id = await self._retry_with_backoff(
+                lambda: self._lookup_existing_id(service_id)
+            )
+            if self._api_available is False:
+                return None
+            if existing_id is not None:
+                return self._skip_result(service_id, existing_id)
+            
+            invoice_file = Path(row["invoice_file"])
+            invoice_bytes = await asyncio.to_thread(invoice_file.read_bytes)
+            fields = {
+                "service_id": service_id,
+                "price": row["price_str"],
+                "invoice": {
+                    "name": invoice_file.name,
+                    "mimeType": mimetypes.guess_type(invoice_file.name)[0] or "application/octet-stream",
+                    "buffer": invoice_bytes,
+                },
+            }
+            
+            # Add optional fields if present
+            if "description" in row and row["description"]:
+                fields["description"] = str(row["description"])
+            
+            if "invoice_date" in row and row["invoice_date"]:
+                fields["invoice_date"] = str(row["invoice_date"])
+            
+            async def do_post():
+                response = await self.context.request.post(
+                    f"{BASE_URL}{TODO_API_SERVICES}", multipart=fields
+                )
+                if response.status in API_MISSING_STATUSES:
+                    return None
+                if response.status == 429:
+                    raise RuntimeError(f"429 Rate Limit: {response.status_text}")
+                if response.status == 409:
+                    # Duplicate created since the lookup; the portal returns the existing record
+                    existing_id = (await response.json()).get("portal_id", "unknown")
+                    return self._skip_result(service_id, existing_id)
+                if not response.ok:
+                    raise RuntimeError(f"HTTP {response.status}: {await response.text()}")
+                
+                return {
+                    "status": "OK",
+                    "portal_id": str((await response.json())["portal_id"]),
+                    "error_msg": None,
+                    "processed_ts": _processed_ts()
+                }
+            
+            # Execute with retry
+            result = await self._retry_with_backoff(do_post)
+            
+        except Exception as e:
+            return self._error_result(row, f"{type(e).__name__}: {str(e)}", start_time)
+        
+        if result is None:
+            self._mark_api_missing()
+            return None
+        
+        if result["status"] == "OK":
+            self._log_success(row, result["portal_id"], start_time)
+        
+        return result
+
+    async def _upload_row_form(self, row: Dict[str, Any], start_time: float) -> Dict[str, Any]:
+        """Upload a single row by filling in the new-service form on a pooled page.
+        
+        Args:
+            row: Row dictionary, as accepted by `upload_row`
+            start_time: When the row's upload started, for logging
+            
+        Returns:
+            Dict with status, portal_id (if successful), and error message (if failed)
+        """
+        service_id = row["service_id"]
+        page, locators = await self._page_pool.get()
+    
         try:
             # Define the actual upload process as a nested function for retry
             async def do_upload():
                 # Navigate to new service page
                 await page.goto(f"{BASE_URL}/new-service")
+            
+                # Check for duplicate (if service_id already exists) in one round-trip;
+                # the form is only used once the services API is known to be missing
+                existing_id = await page.evaluate(
+                    FIND_DUPLICATE_JS,
+                    [service_id, TODO_SELECTOR_SERVICE_TABLE, TODO_SELECTOR_PORTAL_ID],
+                )
                 
-                # Check for duplicate (if service_id already exists)
-                service_id = str(row["service_id"])
-                duplicate_check = await page.locator(f"{TODO_SELECTOR_SERVICE_TABLE} >> text={service_id}").count()
-                
-                if duplicate_check > 0:
-                    # Get the existing portal ID if possible
-                    try:
-                        existing_id = await page.locator(f"{TODO_SELECTOR_SERVICE_TABLE} >> text={service_id}")
-                        existing_id = await existing_id.evaluate("el => el.closest('tr').querySelector('[data-portal-id]').textContent")
-                    except:
-                        existing_id = "unknown"
-                        
-                    logger.info(f"[ROW_SKIP] service_id={service_id} (duplicate found, portal_id={existing_id})")
-                    return {
-                        "status": "SKIP", 
-                        "portal_id": existing_id, 
-                        "error_msg": None,
-                        "processed_ts": datetime.now().isoformat()
-                    }
-                
-                # Log the upload attempt
-                logger.info(f"[ROW_START] service_id={service_id}, invoice_path={row['invoice_path']}")
-                
+                if existing_id is not None:
+                    return self._skip_result(service_id, existing_id)
+            
                 # Fill the form
-                await page.fill(TODO_SELECTOR_SERVICE_ID, service_id)
-                await page.fill(TODO_SELECTOR_PRICE, format(float(row["price"]), '.2f'))
-                
+                await locators["service_id"].fill(service_id)
+                await locators["price"].fill(row["price_str"])
+            
                 # Set file input (invoice)
-                invoice_path = Path(row["invoice_path"]).resolve()
-                await page.set_input_files(TODO_SELECTOR_INVOICE_FILE, str(invoice_path))
-                
+                await locators["invoice_file"].set_input_files(row["invoice_file"])
+            
                 # Fill optional fields if present
                 if "description" in row and row["description"]:
-                    await page.fill(TODO_SELECTOR_DESCRIPTION, str(row["description"]))
-                
+                    await locators["description"].fill(str(row["description"]))
+            
                 if "invoice_date" in row and row["invoice_date"]:
-                    await page.fill(TODO_SELECTOR_INVOICE_DATE, str(row["invoice_date"]))
-                
+                    await locators["invoice_date"].fill(str(row["invoice_date"]))
+            
                 # Submit form
-                await page.click(TODO_SELECTOR_SUBMIT_BUTTON)
-                
+                await locators["submit"].click()
+            
                 # Wait for success message
-                await page.wait_for_selector(TODO_SELECTOR_SUCCESS, timeout=5000)
-                
+                await locators["success"].wait_for(timeout=5000)
+            
                 # Extract portal ID
-                portal_id = await page.locator(TODO_SELECTOR_PORTAL_ID).inner_text()
-                
+                portal_id = await locators["portal_id"].inner_text()
+            
                 return {
                     "status": "OK",
                     "portal_id": portal_id,
                     "error_msg": None,
-                    "processed_ts": datetime.now().isoformat()
+                    "processed_ts": _processed_ts()
                 }
-            
+        
             # Execute with retry
             result = await self._retry_with_backoff(do_upload)
-            
+        
             # If successful, log the timing
             if result["status"] == "OK":
-                elapsed_ms = int((time.time() - start_time) * 1000)
-                logger.info(f"[ROW_SUCCESS] service_id={row['service_id']}, portal_id={result['portal_id']}, time={elapsed_ms}ms")
-            
+                self._log_success(row, result["portal_id"], start_time)
+        
             return result
-            
+        
         except Exception as e:
-            elapsed_ms = int((time.time() - start_time) * 1000)
-            error_msg = f"{type(e).__name__}: {str(e)}"
-            logger.error(f"[ROW_ERROR] service_id={row['service_id']}, error={error_msg}, time={elapsed_ms}ms")
-            
-            return {
-                "status": "ERROR",
-                "portal_id": None,
-                "error_msg": error_msg,
-                "processed_ts": datetime.now().isoformat()
-            }
-            
+            return self._error_result(row, f"{type(e).__name__}: {str(e)}", start_time)
+        
         finally:
-            await page.close()
\ No newline at end of file
+            # Reset the page before handing it back to the pool
+            try:
+                await page.goto("about:blank")
+            except Exception:
+                # Page is unusable, replace it with a fresh one
+                await page.close()
+                page = await self.context.new_page()
+                locators = _form_locators(page)
+            self._page_pool.put_nowait((page, locators))
\ No newline at end of file
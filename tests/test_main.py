@@ -0,0 +1,167 @@
+import asyncio
+import time
+from contextlib import aclosing
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from invoice_bot import main as main_module
+from invoice_bot import portal_uploader
+
+
+class FailingUploader(portal_uploader.PortalUploader):
+    """Uploader whose browser session cannot start."""
+
+    async def __aenter__(self):
+        raise RuntimeError("profile in use")
+
+
+@pytest.mark.asyncio
+async def test_main_returns_1_when_session_fails(tmp_path, monkeypatch):
+    """A browser launch, portal or login failure is a startup error (exit code 1)."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "services.csv").write_text("service_id,price,invoice_path\nINV-1,1.00,a.pdf\n")
+    monkeypatch.setattr(main_module, "PortalUploader", FailingUploader)
+    
+    assert await main_module.main("services.csv") == 1
+    # No result file is started for a run that never began
+    assert not list(tmp_path.glob("run-*.csv"))
+
+
+class SlowReader:
+    """Chunked reader stand-in that records whether a read is in progress."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self.reading = False
+
+    def __next__(self):
+        self.reading = True
+        time.sleep(0.05)
+        self.reading = False
+        return next(self._chunks)
+
+
+@pytest.mark.asyncio
+async def test_iter_records_waits_for_read_ahead_on_close():
+    """Closing the generator early must not leave a read running on the reader."""
+    chunk = pd.DataFrame({"service_id": ["INV-1"], "price": [1.0], "invoice_path": ["a.pdf"]})
+    reader = SlowReader([chunk, chunk.copy(), chunk.copy()])
+    
+    async with aclosing(main_module.iter_records(reader, Path("services.csv"))) as chunks:
+        async for _ in chunks:
+            break  # The second chunk is now being read ahead
+    
+    assert not reader.reading
+
+
+class RecordingUploader(portal_uploader.PortalUploader):
+    """Uploader that answers from memory and tracks uploads in flight."""
+
+    def __init__(self, concurrency):
+        super().__init__(concurrency=concurrency)
+        self.in_flight = 0
+        self.peak = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def _upload_row_api(self, row, start_time):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        return {"status": "OK", "portal_id": f"P-{row['service_id']}", "error_msg": None, "processed_ts": "ts"}
+
+
+async def _as_chunks(rows, chunk_size):
+    for i in range(0, len(rows), chunk_size):
+        yield rows[i:i + chunk_size]
+
+
+def _rows(count):
+    return [
+        {"service_id": f"INV-{i}", "price": 1.0, "price_str": "1.00", "invoice_path": "a.pdf", "invoice_file": "/a.pdf"}
+        for i in range(count)
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("count", [0, 1, 3, 20, 60])
+async def test_upload_records_writes_every_row_once(count):
+    """Every row is written exactly once and the workers stop on their sentinels."""
+    uploader = RecordingUploader(concurrency=4)
+    written = []
+    
+    async def write_result(row):
+        written.append(row)
+    
+    # Hangs here if a worker never sees its sentinel
+    await asyncio.wait_for(
+        main_module.upload_records(uploader, _as_chunks(_rows(count), 7), 4, write_result), timeout=5
+    )
+    
+    assert sorted(row["service_id"] for row in written) == sorted(row["service_id"] for row in _rows(count))
+    assert all(row["portal_id"] == f"P-{row['service_id']}" for row in written)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("count", [1, 3, 20, 60])
+async def test_upload_records_runs_concurrency_uploads_at_once(count):
+    """The worker pool keeps `concurrency` uploads in flight, and no more."""
+    uploader = RecordingUploader(concurrency=4)
+    
+    async def write_result(row):
+        pass
+    
+    await main_module.upload_records(uploader, _as_chunks(_rows(count), 7), 4, write_result)
+    
+    assert uploader.peak == min(count, 4)
+
+
+@pytest.mark.asyncio
+async def test_iter_records_coerces_fields(tmp_path):
+    """Missing cells become None, prices are formatted and invoice paths resolved."""
+    invoice = tmp_path / "a.pdf"
+    invoice.write_bytes(b"%PDF")
+    csv_file = tmp_path / "services.csv"
+    csv_file.write_text(
+        "service_id,price,invoice_path,description\n"
+        f"1001,1.5,{invoice},Monthly\n"
+        f"1002,abc,{tmp_path / 'missing.pdf'},\n"
+        f"1003,3,{invoice},Extra\n"
+        f",4,{invoice},\n"
+    )
+    
+    with pd.read_csv(csv_file, chunksize=2, dtype=main_module.CSV_DTYPES) as reader:
+        async with aclosing(main_module.iter_records(reader, csv_file)) as chunks:
+            records = [record async for records in chunks for record in records]
+    
+    # The blank id in the second chunk must not make 1003 a float
+    assert [record["service_id"] for record in records] == ["1001", "1002", "1003", None]
+    first, second, third, _ = records
+    assert first["service_id"] == "1001"
+    assert first["price_str"] == "1.50"
+    assert first["invoice_file"] == str(invoice.resolve())
+    # Unparseable prices and missing files are left for upload_row to reject
+    assert second["price_str"] is None
+    assert second["invoice_file"] is None
+    assert second["description"] is None
+    assert third["price_str"] == "3.00"
+
+
+@pytest.mark.asyncio
+async def test_main_returns_1_on_malformed_row(tmp_path, monkeypatch):
+    """A row the CSV parser rejects mid-stream is a read error (exit code 1)."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "a.pdf").write_bytes(b"%PDF")
+    (tmp_path / "services.csv").write_text(
+        "service_id,price,invoice_path\nINV-1,1.00,a.pdf\nINV-2,2.00,a.pdf,extra\n"
+    )
+    monkeypatch.setattr(main_module, "PortalUploader", lambda **kwargs: RecordingUploader(kwargs["concurrency"]))
+    
+    assert await main_module.main("services.csv", concurrency=2) == 1
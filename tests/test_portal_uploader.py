@@ -0,0 +1,233 @@
+import asyncio
+import re
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from invoice_bot import portal_uploader
+from invoice_bot.portal_uploader import PortalUploader
+
+
+def test_processed_ts_format():
+    """Timestamps are local ISO 8601 with milliseconds."""
+    before = datetime.now().replace(microsecond=0)
+    ts = portal_uploader._processed_ts()
+    after = datetime.now()
+    
+    assert re.fullmatch(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}", ts)
+    assert before <= datetime.fromisoformat(ts) <= after
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_cooldown_is_shared(monkeypatch):
+    """A 429 on one row holds back every other caller until the cooldown ends."""
+    monkeypatch.setattr(portal_uploader, "MAX_BACKOFF_SEC", 0.2)
+    uploader = PortalUploader()
+    limited = asyncio.Event()
+    attempts = []
+    
+    async def rate_limited_once():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            limited.set()
+            raise RuntimeError("429 Rate Limit: Too Many Requests")
+        return "ok"
+    
+    async def other_worker():
+        await limited.wait()
+        start = time.monotonic()
+        await uploader.wait_for_cooldown()
+        return time.monotonic() - start
+    
+    result, waited = await asyncio.gather(uploader._retry_with_backoff(rate_limited_once), other_worker())
+    
+    assert result == "ok"
+    assert waited >= 0.15
+    assert attempts[1] - attempts[0] >= 0.15
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_never_shortens_cooldown(monkeypatch):
+    """A shorter backoff from another row does not cut an active cooldown short."""
+    monkeypatch.setattr(portal_uploader, "MAX_BACKOFF_SEC", 0.01)
+    uploader = PortalUploader()
+    uploader._rate_limit_until = deadline = time.monotonic() + 0.2
+    
+    async def rate_limited():
+        raise RuntimeError("429 Rate Limit")
+    
+    with pytest.raises(RuntimeError):
+        await uploader._retry_with_backoff(rate_limited, max_retries=1)
+    
+    assert uploader._rate_limit_until >= deadline
+
+
+class FakeResponse:
+    """APIResponse stand-in with a fixed status and body."""
+
+    def __init__(self, status, body=None):
+        self.status = status
+        self.ok = 200 <= status < 300
+        self.status_text = "status text"
+        self._body = body
+
+    async def json(self):
+        if isinstance(self._body, str):
+            raise ValueError("not json")
+        return self._body
+
+    async def text(self):
+        return str(self._body)
+
+
+class FakeRequest:
+    """APIRequestContext stand-in answering GETs and POSTs from queues."""
+
+    def __init__(self, gets, posts=()):
+        self.gets = list(gets)
+        self.posts = list(posts)
+        self.posted = []
+
+    async def get(self, url, params=None):
+        return self.gets.pop(0)
+
+    async def post(self, url, multipart=None):
+        self.posted.append(multipart)
+        return self.posts.pop(0)
+
+
+class ApiUploader(PortalUploader):
+    """Uploader talking to a fake services API, with a stubbed form path."""
+
+    def __init__(self, request):
+        super().__init__()
+        self.context = SimpleNamespace(request=request)
+        self.form_rows = []
+
+    async def _upload_row_form(self, row, start_time):
+        self.form_rows.append(row["service_id"])
+        return {"status": "OK", "portal_id": "form", "error_msg": None, "processed_ts": "ts"}
+
+
+@pytest.fixture
+def row(tmp_path):
+    invoice = tmp_path / "a.pdf"
+    invoice.write_bytes(b"%PDF")
+    return {"service_id": "INV-1", "price": 1.5, "price_str": "1.50", "invoice_path": "a.pdf", "invoice_file": str(invoice)}
+
+
+@pytest.mark.asyncio
+async def test_api_upload_ok(row):
+    """A lookup miss is followed by a POST with the row's fields."""
+    request = FakeRequest([FakeResponse(200, [])], [FakeResponse(201, {"portal_id": 7})])
+    uploader = ApiUploader(request)
+    
+    result = await uploader.upload_row(row)
+    
+    assert result["status"] == "OK"
+    assert result["portal_id"] == "7"
+    assert uploader._api_available is True
+    assert request.posted[0]["price"] == "1.50"
+    assert request.posted[0]["invoice"]["buffer"] == b"%PDF"
+    assert not uploader.form_rows
+
+
+@pytest.mark.asyncio
+async def test_api_lookup_hit_skips(row):
+    """An existing service is skipped without posting."""
+    request = FakeRequest([FakeResponse(200, [{"portal_id": "P-9"}])])
+    uploader = ApiUploader(request)
+    
+    result = await uploader.upload_row(row)
+    
+    assert result["status"] == "SKIP"
+    assert result["portal_id"] == "P-9"
+    assert not request.posted
+
+
+@pytest.mark.asyncio
+async def test_api_conflict_on_post_skips(row):
+    """A 409 from a duplicate created since the lookup is a SKIP."""
+    request = FakeRequest([FakeResponse(200, [])], [FakeResponse(409, {"portal_id": "P-9"})])
+    
+    result = await ApiUploader(request).upload_row(row)
+    
+    assert result["status"] == "SKIP"
+    assert result["portal_id"] == "P-9"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("response", [
+    FakeResponse(404),
+    FakeResponse(401),
+    FakeResponse(403),
+    FakeResponse(405),
+    FakeResponse(200, "<html>login</html>"),
+    FakeResponse(200, {"services": []}),
+], ids=["404", "401", "403", "405", "html", "dict"])
+async def test_api_lookup_unusable_falls_back_to_form(row, response):
+    """A missing or non-API lookup response switches the run to the form."""
+    request = FakeRequest([response])
+    uploader = ApiUploader(request)
+    
+    result = await uploader.upload_row(row)
+    
+    assert result["portal_id"] == "form"
+    assert uploader._api_available is False
+    assert not request.posted
+    # Later rows go straight to the form
+    await uploader.upload_row({**row, "service_id": "INV-2"})
+    assert uploader.form_rows == ["INV-1", "INV-2"]
+
+
+@pytest.mark.asyncio
+async def test_api_post_missing_falls_back_to_form(row):
+    """A 404 on the POST also switches the run to the form."""
+    request = FakeRequest([FakeResponse(200, [])], [FakeResponse(404)])
+    uploader = ApiUploader(request)
+    
+    result = await uploader.upload_row(row)
+    
+    assert result["portal_id"] == "form"
+    assert uploader._api_available is False
+
+
+@pytest.mark.asyncio
+async def test_api_server_error_is_row_error(row):
+    """Other failures fail the row but keep using the API."""
+    request = FakeRequest([FakeResponse(500, "boom")])
+    uploader = ApiUploader(request)
+    
+    result = await uploader.upload_row(row)
+    
+    assert result["status"] == "ERROR"
+    assert "HTTP 500" in result["error_msg"]
+    assert uploader._api_available is None
+    assert not uploader.form_rows
+
+
+@pytest.mark.asyncio
+async def test_api_rate_limit_enters_shared_cooldown(row, monkeypatch):
+    """A 429 from the API sets the shared cooldown and the row is retried."""
+    monkeypatch.setattr(portal_uploader, "MAX_BACKOFF_SEC", 0.05)
+    request = FakeRequest(
+        [FakeResponse(429), FakeResponse(200, [])],
+        [FakeResponse(429), FakeResponse(201, {"portal_id": 7})],
+    )
+    uploader = ApiUploader(request)
+    before = time.monotonic()
+    
+    result = await uploader.upload_row(row)
+    
+    assert result["status"] == "OK"
+    assert uploader._rate_limit_until > before
+    assert len(request.posted) == 2
+
+
+def test_api_can_be_disabled(monkeypatch):
+    """PORTAL_USE_API=0 starts the run on the form."""
+    monkeypatch.setattr(portal_uploader, "USE_SERVICES_API", False)
+    
+    assert PortalUploader()._api_available is False